@@ -23,6 +23,8 @@ Runner:
 
 import argparse
 import csv
+import functools
+import io
 import itertools
 import json
 import os
@@ -33,15 +35,26 @@ import sys
 import time
 import yaml
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 VAR_RE = re.compile(r"\{\{\s*([A-Za-z0-9_\.]+)\s*\}\}")
 SNIPPET_TOKEN_RE = re.compile(r"^\{\{\s*snippet\.([A-Za-z0-9_-]+)\s*\}\}$")
+# load_tests reads spec files in threads from this many files on
+PARALLEL_LOAD_MIN = 64
+# libyaml also decodes UTF-16 input when it starts with a BOM
+UTF16_BOMS = (b"\xff\xfe", b"\xfe\xff")
+# characters that make shlex.split do more than return the string itself
+SHLEX_SPECIAL = frozenset(" \t\r\n'\"\\")
 
 
-def ctx_lookup(ctx, path):
-    parts = path.split(".")
+def ctx_lookup(ctx, parts):
     cur = ctx
     for p in parts:
         if isinstance(cur, dict) and p in cur:
@@ -51,31 +64,53 @@ def ctx_lookup(ctx, path):
     return cur
 
 
-def render_string(s, ctx):
-    # Render {{ var }} or {{ foo.bar }}
-    def repl(m):
-        key = m.group(1).strip()
-        val = ctx_lookup(ctx, key)
-        return "" if val is None else str(val)
-    return VAR_RE.sub(repl, s)
+@functools.lru_cache(maxsize=None)
+def compile_string(s):
+    # Split once into [text, var, text, var, ..., text]; job items repeat
+    # for every permutation, so the regex scan is done only once per string.
+    # Variables are stored as their dotted path already split.
+    if "{{" not in s:
+        # skips one regex split per distinct string; the result is cached
+        return (s,)
+    parts = VAR_RE.split(s)
+    for i in range(1, len(parts), 2):
+        parts[i] = tuple(parts[i].split("."))
+    return tuple(parts)
 
 
-def render_job_to_argv(spec, ctx):
+def render_string(s, ctx):
+    # Render {{ var }} or {{ foo.bar }}
+    parts = compile_string(s)
+    if len(parts) == 1:
+        # plain text, nothing to substitute
+        return s
+    out = list(parts)
+    for i in range(1, len(out), 2):
+        val = ctx_lookup(ctx, out[i])
+        out[i] = "" if val is None else str(val)
+    return "".join(out)
+
+
+def prepare_job(spec):
     """
     job: list of strings
       - if item is exactly "{{ snippet.NAME }}", inject snippet content as ONE arg (after rendering)
       - else render with ctx and shlex.split (so "--flag 8" can be written together)
     snippets: [{name, content}]
+
+    Done once per test; returns (kind, value) pairs for render_job_to_argv:
+      - ("snippet", template): rendered into one arg
+      - ("split", template): rendered, then shlex.split
+      - ("static", tokens): no variables, split here once and the same token
+        strings are reused by every permutation
     """
-    job = spec.get("job", [])
-    if not isinstance(job, list) or not job:
-        raise ValueError("`job` must be a non-empty list")
+    job = spec["job"]
 
     sn_map = {}
     for s in (spec.get("snippets") or []):
         sn_map[s["name"]] = s["content"]
 
-    argv = []
+    prepared = []
     for item in job:
         raw = str(item).strip()
 
@@ -85,24 +120,44 @@ def render_job_to_argv(spec, ctx):
             sn_name = m.group(1)
             if sn_name not in sn_map:
                 raise ValueError("snippet '{}' not found".format(sn_name))
-            body = render_string(sn_map[sn_name], ctx)
-            argv.append(body)
+            prepared.append(("snippet", sn_map[sn_name]))
             continue
 
-        rendered = render_string(raw, ctx)
-        argv.extend(shlex.split(rendered))
+        if len(compile_string(raw)) == 1:
+            prepared.append(("static", tuple(shlex.split(raw))))
+        else:
+            prepared.append(("split", raw))
+    return prepared
+
+
+def render_job_to_argv(job, ctx):
+    argv = []
+    for kind, value in job:
+        if kind == "static":
+            argv.extend(value)
+        elif kind == "snippet":
+            argv.append(render_string(value, ctx))
+        else:
+            rendered = render_string(value, ctx)
+            if rendered and SHLEX_SPECIAL.isdisjoint(rendered):
+                argv.append(rendered)
+            else:
+                argv.extend(shlex.split(rendered))
     return argv
 
 
 def cartesian_params(param_dict):
-    if not param_dict:
-        return [({})]
-    keys = list(param_dict.keys())
+    # lazy: permutations are consumed once, no need to hold them all
+    keys = list(param_dict.keys()) if param_dict else []
     vals = [param_dict[k] for k in keys]
-    combos = []
-    for tup in itertools.product(*vals):
-        combos.append(dict(zip(keys, tup)))
-    return combos
+    return (dict(zip(keys, tup)) for tup in itertools.product(*vals))
+
+
+def count_params(param_dict):
+    n = 1
+    for v in (param_dict or {}).values():
+        n *= len(v)
+    return n
 
 
 def run_argv(argv, env, cwd, timeout):
@@ -154,13 +209,15 @@ def write_perflog(prefix, sysenv, testname, params, duration_s, status, message,
         w.writerow(row)
 
 
-def load_func(code_str, func_name):
+def load_func(code_str, func_name, filename="<string>"):
     """
     Exec code_str and return function named func_name.
     Trusted code: full Python environment.
     """
+    # name the YAML file and block in tracebacks from user code
+    code = compile(code_str, "{}:{}".format(filename, func_name), "exec")
     ns = {}
-    exec(code_str, ns, ns)
+    exec(code, ns)
     fn = ns.get(func_name)
     if not callable(fn):
         raise ValueError("`{}` block must define a function named `{}`".format(func_name, func_name))
@@ -171,28 +228,101 @@ def require_parse(spec):
     code = spec.get("parse")
     if not code:
         return None
-    return load_func(code, "parse")
+    return load_func(code, "parse", spec["_file"])
 
 
 def require_validate(spec):
     code = spec.get("validate")
     if not code:
         return None
-    return load_func(code, "validate")
+    return load_func(code, "validate", spec["_file"])
+
+
+def check_spec(spec):
+    """
+    Check the layout described in the module docstring once at load time,
+    instead of failing later in the middle of a run.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("top level must be a mapping")
+    job = spec.get("job")
+    if not isinstance(job, list) or not job:
+        raise ValueError("`job` must be a non-empty list")
+    params = spec.get("params") or {}
+    if not isinstance(params, dict) or not all(isinstance(v, list) for v in params.values()):
+        raise ValueError("`params` must map names to lists of values")
+    if not isinstance(spec.get("env") or {}, dict):
+        raise ValueError("`env` must be a mapping")
+    if not isinstance(spec.get("tags") or [], list):
+        raise ValueError("`tags` must be a list")
+    snippets = spec.get("snippets") or []
+    if not isinstance(snippets, list) or not all(isinstance(sn, dict) and "name" in sn and "content" in sn for sn in snippets):
+        raise ValueError("`snippets` must be a list of {name, content}")
+    for key in ("parse", "validate"):
+        if not isinstance(spec.get(key) or "", str):
+            raise ValueError("`{}` must be a string of Python code".format(key))
+    for key in ("name", "workdir"):
+        if not isinstance(spec.get(key) or "", str):
+            raise ValueError("`{}` must be a string".format(key))
+
+
+def load_spec(p, tag_filter):
+    if not tag_filter:
+        # let libyaml read the file itself, no intermediate copy
+        with p.open("rb") as f:
+            return yaml.load(f, Loader=SafeLoader)
+    raw = p.read_bytes()
+    # cheap prefilter: a file that does not even mention a wanted tag cannot
+    # match, so skip parsing it (the tags check after parsing is authoritative).
+    # Only done for UTF-8 input; a tag written with a YAML escape ("gp\x75")
+    # is not seen by it and the file is skipped.
+    if not raw.startswith(UTF16_BOMS) and not any(t.encode() in raw for t in tag_filter):
+        return None
+    # same parse as the streaming path above, so errors name the file too
+    stream = io.BytesIO(raw)
+    stream.name = str(p)
+    return yaml.load(stream, Loader=SafeLoader)
 
 
 def load_tests(dirpath, tag_filter):
-    tests = []
-    for p in sorted(Path(dirpath).glob("*.yaml")):
+    try:
+        with os.scandir(dirpath) as it:
+            paths = sorted(Path(e.path) for e in it if e.name.endswith(".yaml") and e.is_file())
+    except OSError as e:
+        print("[WARN] Cannot read {}: {}".format(dirpath, e), file=sys.stderr)
+        return []
+
+    def load_one(p):
         try:
-            data = yaml.safe_load(p.read_text())
+            return load_spec(p, tag_filter), None
         except Exception as e:
-            print("[WARN] Failed to parse {}: {}".format(p, e), file=sys.stderr)
+            return None, e
+
+    # libyaml holds the GIL while parsing, so threads only overlap the file
+    # reads; that only pays off for large directories on slow filesystems
+    if len(paths) >= PARALLEL_LOAD_MIN:
+        with ThreadPoolExecutor(max_workers=32) as ex:
+            loaded = list(ex.map(load_one, paths))
+    else:
+        loaded = [load_one(p) for p in paths]
+
+    tests = []
+    for p, (data, err) in zip(paths, loaded):
+        if err is not None:
+            print("[WARN] Failed to parse {}: {}".format(p, err), file=sys.stderr)
+            continue
+        if data is None and tag_filter:
+            continue
+        try:
+            check_spec(data)
+        except ValueError as e:
+            print("[WARN] Invalid test {}: {}".format(p, e), file=sys.stderr)
             continue
         data["_file"] = str(p)
-        data.setdefault("tags", [])
-        data.setdefault("params", {})
-        data.setdefault("env", {})
+        # an empty `key:` in YAML is null; treat it like a missing key
+        data["tags"] = data.get("tags") or []
+        data["params"] = data.get("params") or {}
+        data["env"] = data.get("env") or {}
         if tag_filter and not (set(tag_filter) & set(data.get("tags", []))):
             continue
         tests.append(data)
@@ -231,33 +361,47 @@ def main():
         param_space = cartesian_params(spec.get("params", {}))
         pkeys = list(spec.get("params", {}).keys())
 
-        print("\n=== {} ({} permutations) ===".format(name, len(param_space)))
+        print("\n=== {} ({} permutations) ===".format(name, count_params(spec.get("params", {}))))
         if desc:
             print(desc)
         if pkeys:
             hdr = " ".join("{:>14s}".format(h) for h in (pkeys + ["status", "message"]))
             print(hdr)
 
-        # Load parse & validate once per test file
-        parse_fn = require_parse(spec)
-        validate_fn = require_validate(spec)
+        # Load parse & validate once per test file; a dry run never calls them
+        parse_fn, validate_fn = None, None
+        if not args.dry_run:
+            parse_fn = require_parse(spec)
+            validate_fn = require_validate(spec)
 
-        for params in param_space:
-            # env = static + params
-            env_vars = dict(spec.get("env", {}))
-            env_vars.update({k: v for k, v in params.items()})
+        # job layout and snippets do not depend on params
+        job, job_error = None, None
+        try:
+            job = prepare_job(spec)
+        except Exception as e:
+            job_error = e
+
+        # env = static + params, templating context = extra_args + params;
+        # every permutation has the same keys, so both dicts are built once
+        # and updated in place
+        env_vars = dict(spec.get("env", {}))
+        ctx = {"extra_args": extra_args}
 
-            # templating context
-            ctx = {"extra_args": extra_args}
+        for params in param_space:
+            env_vars.update(params)
             ctx.update(params)
 
             # argv
-            try:
-                argv = render_job_to_argv(spec, ctx)
-            except Exception as e:
+            spec_error = job_error
+            if spec_error is None:
+                try:
+                    argv = render_job_to_argv(job, ctx)
+                except Exception as e:
+                    spec_error = e
+            if spec_error is not None:
                 line = " ".join("{:>14s}".format(str(params.get(k, ""))) for k in pkeys) if pkeys else ""
-                print((line + " ").rstrip(), "[FAIL]", "spec error: {}".format(e))
-                write_perflog(args.prefix, args.sysenv, name, params, 0.0, False, "spec error: {}".format(e), {})
+                print((line + " ").rstrip(), "[FAIL]", "spec error: {}".format(spec_error))
+                write_perflog(args.prefix, args.sysenv, name, params, 0.0, False, "spec error: {}".format(spec_error), {})
                 any_fail = True
                 continue
 